@@ -4,15 +4,31 @@ Provides semantic search capabilities using embeddings
 """
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
-import json
+from pydantic import BaseModel, Field
+from typing import List, Optional, Dict, Any, Callable, Iterable, Tuple
 import numpy as np
+import orjson
+import sqlite3
 from openai import OpenAI
 import os
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
+import mmap
+import threading
 from dotenv import load_dotenv
-import pickle
 from pathlib import Path
+import json
+
+try:
+    import simsimd  # Optional: SIMD-accelerated (AVX-512/NEON) distances
+except ImportError:
+    simsimd = None
+
+try:
+    from usearch.index import Index as AnnIndex  # Optional: HNSW graph index
+except ImportError:
+    AnnIndex = None
 
 load_dotenv()
 
@@ -31,22 +47,90 @@ app.add_middleware(
 openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # Storage paths
-EMBEDDINGS_FILE = Path("data/embeddings.pkl")
-CONVERSATIONS_FILE = Path("data/conversations_cache.json")
+EMBEDDINGS_MATRIX = Path("data/embeddings.npy")
+EMBEDDINGS_INT8 = Path("data/embeddings_int8.npy")
+EMBEDDINGS_BINARY = Path("data/embeddings_binary.npy")
+METADATA_FILE = Path("data/embeddings_meta.npz")
+INDEX_INFO_FILE = Path("data/index_info.json")
+CONTENT_HASHES = Path("data/content_hashes.npy")
+ROW_KEYS = Path("data/row_keys.npy")
+ANN_INDEX_FILE = Path("data/ann.usearch")
+CONVERSATIONS_DB = Path("data/conversations.sqlite")
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+# Messages sent per embeddings request, and requests kept in flight at once
+EMBEDDING_BATCH_SIZE = 256
+EMBEDDING_WORKERS = 4
+# UTF-8 bytes per embeddings request: the API also caps the tokens summed over
+# all inputs of a request (300k), and a byte-level BPE token always covers at
+# least one byte (CJK text or emoji can take several tokens per character)
+EMBEDDING_BATCH_BYTES = 200_000
+
+# On-disk dtype of the full-precision matrix: 'float16' halves its size and
+# the bytes each search reads, at ~1e-3 precision on the similarity scores
+EMBEDDING_DTYPE_NAME = os.getenv("EMBEDDING_DTYPE", "float32").lower()
+if EMBEDDING_DTYPE_NAME not in ('float32', 'float16'):
+    raise ValueError(f"EMBEDDING_DTYPE must be 'float32' or 'float16', got {EMBEDDING_DTYPE_NAME!r}")
+EMBEDDING_DTYPE = np.dtype(EMBEDDING_DTYPE_NAME)
+
+# Search quantization: 'none' scans the float32 matrix directly, 'int8' scans
+# the 4x smaller int8 copy and 'binary' the 32x smaller sign-bit copy (by
+# Hamming distance); both rescore the best candidates in full precision
+SEARCH_QUANTIZATION = os.getenv("SEARCH_QUANTIZATION", "none").lower()
+if SEARCH_QUANTIZATION not in ('none', 'int8', 'binary'):
+    raise ValueError(f"SEARCH_QUANTIZATION must be 'none', 'int8' or 'binary', got {SEARCH_QUANTIZATION!r}")
+# Rows are unit-length, so every component fits a single global int8 scale
+INT8_SCALE = 127
+# Candidates rescored per requested result when searching a quantized index
+RERANK_OVERSAMPLE = 4
+
+# Indexes with at least this many rows also get an HNSW graph (if usearch is
+# installed), making search sublinear instead of a scan over every row
+ANN_MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", "50000"))
+
+# Rows per scan tile are sized to ~1 MB, so a tile stays in cache while it
+# is scored instead of streaming the whole matrix through L3 at once
+SCAN_BLOCK_BYTES = 1 << 20
+
+# Set bits per byte value, for NumPy versions without np.bitwise_count
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Per-row metadata, stored as parallel NumPy columns alongside the embeddings
+# matrix (row i of every column describes row i of the matrix)
+METADATA_FIELDS = [
+    'conversation_id',
+    'conversation_title',
+    'conversation_type',
+    'message_id',
+    'message_content',
+    'message_role',
+    'timestamp',
+    'workspace_folder',
+]
+
+# Loaded index files, reused across requests: path -> (mtime, value)
+_CACHE: Dict[Path, Any] = {}
+
+# Scan scratch buffers, reused across requests and grown on demand; only
+# used while holding _SCRATCH_LOCK
+_SCRATCH: Dict[str, np.ndarray] = {}
+_SCRATCH_LOCK = threading.Lock()
 
 # Ensure data directory exists
-EMBEDDINGS_FILE.parent.mkdir(exist_ok=True)
+EMBEDDINGS_MATRIX.parent.mkdir(exist_ok=True)
 
 
 class SemanticSearchRequest(BaseModel):
     query: str
-    top_k: int = 5
+    top_k: int = Field(5, ge=1)
     filter_type: Optional[str] = None  # 'chat' or 'composer'
     min_score: float = 0.7
 
 
 class IndexRequest(BaseModel):
     export_data: Dict[str, Any]  # The exported JSON from /api/export
+    incremental: bool = True  # Only embed messages not already indexed
 
 
 class SearchResult(BaseModel):
@@ -74,11 +158,12 @@ async def root():
 @app.get("/health")
 async def health():
     """Health check endpoint"""
-    has_embeddings = EMBEDDINGS_FILE.exists()
+    has_embeddings = EMBEDDINGS_MATRIX.exists()
     return {
         "status": "healthy",
         "embeddings_indexed": has_embeddings,
-        "conversation_count": get_indexed_count()
+        "conversation_count": get_indexed_count(),
+        "message_count": get_indexed_message_count()
     }
 
 
@@ -86,13 +171,43 @@ async def health():
 async def index_conversations(request: IndexRequest):
     """
     Index conversations from exported data
-    Creates embeddings for all messages
+    Creates embeddings for all messages, stored as unit-length rows so that
+    search reduces to a dot product. Incremental runs (the default) keep the
+    existing rows of messages whose content is unchanged and only embed the
+    others. The export is complete, so rows and stored conversations missing
+    from it are dropped.
     """
     try:
         data = request.export_data
         conversations = data.get('conversations', [])
 
-        embeddings_data = []
+        # Existing index, extended instead of rebuilt for incremental runs
+        old_E = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        old_metadata = {field: [] for field in METADATA_FIELDS}
+        old_hashes = []
+        old_keys = np.empty(0, dtype=np.int64)  # Stable key of each row
+        next_key = 0
+        has_keys = False  # Whether an existing HNSW graph uses old_keys
+        if request.incremental and EMBEDDINGS_MATRIX.exists():
+            old_E = np.load(EMBEDDINGS_MATRIX).astype(np.float32)
+            old_metadata = {field: column.tolist() for field, column in load_metadata().items()}
+            old_hashes = [h.tobytes() for h in np.load(CONTENT_HASHES)]
+            has_keys = ROW_KEYS.exists()
+            if has_keys:
+                old_keys = np.load(ROW_KEYS)
+                next_key = load_index_info()['next_key']
+            else:
+                old_keys = np.arange(len(old_E), dtype=np.int64)
+                next_key = len(old_E)
+        indexed = {
+            key: row for row, key in
+            enumerate(zip(old_metadata['conversation_id'], old_metadata['message_id']))
+        }
+        keep = np.zeros(len(old_hashes), dtype=bool)  # Existing rows still current
+
+        pending = []  # Message contents to embed, in row order
+        hashes = []  # Content hash of each pending message
+        metadata = {field: [] for field in METADATA_FIELDS}
         conversation_map = {}
 
         print(f"Indexing {len(conversations)} conversations...")
@@ -108,40 +223,172 @@ async def index_conversations(request: IndexRequest):
 
                 if not content or len(content.strip()) < 10:
                     continue  # Skip empty or very short messages
+                h = content_hash(content)
+                row = indexed.get((conv['id'], msg['id']))
+                if row is not None and old_hashes[row] == h:
+                    keep[row] = True
+                    continue  # Already indexed by a previous run, unchanged
+
+                pending.append(content)
+                hashes.append(h)
+                metadata['conversation_id'].append(conv['id'])
+                metadata['conversation_title'].append(conv['title'])
+                metadata['conversation_type'].append(conv['type'])
+                metadata['message_id'].append(msg['id'])
+                metadata['message_content'].append(content)
+                metadata['message_role'].append(msg['role'])
+                metadata['timestamp'].append(msg['timestamp'])
+                metadata['workspace_folder'].append(conv['workspace'].get('folder'))
+
+        if request.incremental and old_hashes and not pending and keep.all():
+            # Nothing new to embed or drop; only refresh the stored
+            # conversations and the titles of renamed conversations
+            titles = refreshed_titles(old_metadata, conversation_map)
+            _CACHE.clear()
+            if titles != old_metadata['conversation_title']:
+                old_metadata['conversation_title'] = titles
+                save_metadata(old_metadata)
+            save_conversations(conversation_map)
+            print(f"\n✓ No new messages in {len(conversations)} conversations")
+            return {
+                "status": "success",
+                "indexed_messages": 0,
+                "embedded_messages": 0,
+                "total_messages": len(old_E),
+                "indexed_conversations": len(conversations)
+            }
+
+        # Identical messages (repeated prompts, errors, "continue") are only
+        # embedded once: a row whose content is already in the index copies
+        # that vector, otherwise it points at the first new row with its content
+        old_rows = {h: row for row, h in enumerate(old_hashes)}
+        old_source = np.array([old_rows.get(h, -1) for h in hashes], dtype=np.intp)
+        hash_to_row = {}
+        source_rows = np.array(
+            [hash_to_row.setdefault(h, row) for row, h in enumerate(hashes)],
+            dtype=np.intp
+        )
+        is_first = source_rows == np.arange(len(pending))
+        unique_rows = np.flatnonzero(is_first & (old_source < 0))
+
+        # Embed in batches, writing straight into one contiguous matrix
+        new_E = np.empty((len(pending), EMBEDDING_DIM), dtype=np.float32)
+        reused = np.flatnonzero(old_source >= 0)
+        new_E[reused] = old_E[old_source[reused]]
+
+        # Batches close at EMBEDDING_BATCH_SIZE messages or EMBEDDING_BATCH_BYTES
+        # UTF-8 bytes, whichever comes first (an oversized message goes alone)
+        batches = []
+        batch, batch_bytes = [], 0
+        for row in unique_rows:
+            size = len(pending[row].encode())
+            full = len(batch) == EMBEDDING_BATCH_SIZE or batch_bytes + size > EMBEDDING_BATCH_BYTES
+            if batch and full:
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(row)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+
+        def embed_batch(batch: List[int]) -> int:
+            response = openai_client.embeddings.create(
+                model=EMBEDDING_MODEL,
+                input=[pending[row] for row in batch]
+            )
+            for item in response.data:
+                new_E[batch[item.index]] = item.embedding
+            return len(response.data)
+
+        # Requests are I/O-bound, so threads keep several batches in flight
+        with ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS) as executor:
+            embedded = 0
+            for count in executor.map(embed_batch, batches):
+                embedded += count
+                print(f"Indexed message {embedded}/{len(unique_rows)}", end='\r')
+
+        # Fill duplicate rows from the row that was embedded
+        duplicates = np.flatnonzero(~is_first & (old_source < 0))
+        new_E[duplicates] = new_E[source_rows[duplicates]]
+
+        # Normalize rows to unit length once, so search needs no per-row
+        # norms: cosine similarity becomes a single matrix-vector product
+        # (einsum computes the row sums of squares without np.linalg.norm)
+        new_E /= np.sqrt(np.einsum('ij,ij->i', new_E, new_E))[:, np.newaxis]
+
+        # Append the new rows to the existing rows that are still current;
+        # rows of deleted or edited messages are dropped. Every row gets a
+        # key that stays with it across runs (keys are never reused).
+        kept = np.flatnonzero(keep)
+        new_keys = np.arange(next_key, next_key + len(pending), dtype=np.int64)
+        next_key += len(pending)
+        keys = np.concatenate([old_keys[kept], new_keys])
+        E = np.concatenate([old_E[kept], new_E])
+        metadata = {
+            field: [old_metadata[field][i] for i in kept] + metadata[field]
+            for field in METADATA_FIELDS
+        }
+        hashes = [old_hashes[i] for i in kept] + hashes
+
+        # Conversations may have been renamed since their rows were indexed
+        metadata['conversation_title'] = refreshed_titles(metadata, conversation_map)
+
+        # Group rows by conversation type (stable, so each group keeps its
+        # indexing order), letting search filter by type with a contiguous slice
+        types = np.asarray(metadata['conversation_type'], dtype=str)
+        order = np.argsort(types, kind='stable')
+        E = E[order]
+        metadata = {field: [values[i] for i in order] for field, values in metadata.items()}
+        hashes = [hashes[i] for i in order]
+        keys = keys[order]
+        names, starts, counts = np.unique(types[order], return_index=True, return_counts=True)
+        type_ranges = {
+            str(name): [int(start), int(start + count)]
+            for name, start, count in zip(names, starts, counts)
+        }
 
-                # Create embedding
-                response = openai_client.embeddings.create(
-                    model="text-embedding-3-small",
-                    input=content
-                )
-
-                embeddings_data.append({
-                    'embedding': response.data[0].embedding,
-                    'conversation_id': conv['id'],
-                    'conversation_title': conv['title'],
-                    'conversation_type': conv['type'],
-                    'message_id': msg['id'],
-                    'message_content': content,
-                    'message_role': msg['role'],
-                    'timestamp': msg['timestamp'],
-                    'workspace_folder': conv['workspace'].get('folder')
-                })
-
-                print(f"Indexed message {len(embeddings_data)}", end='\r')
-
-        # Save embeddings
-        with open(EMBEDDINGS_FILE, 'wb') as f:
-            pickle.dump(embeddings_data, f)
-
-        # Save conversation map for quick retrieval
-        with open(CONVERSATIONS_FILE, 'w') as f:
-            json.dump(conversation_map, f)
-
-        print(f"\n✓ Indexed {len(embeddings_data)} messages from {len(conversations)} conversations")
+        # Release cached (memory-mapped) files before overwriting them
+        _CACHE.clear()
+
+        # Save embeddings (full precision, int8 and binary) and their metadata
+        np.save(EMBEDDINGS_MATRIX, E.astype(EMBEDDING_DTYPE, copy=False))
+        np.save(EMBEDDINGS_INT8, quantize_int8(E))
+        np.save(EMBEDDINGS_BINARY, np.packbits(E > 0, axis=1))
+        np.save(CONTENT_HASHES, np.frombuffer(b''.join(hashes), dtype=np.uint8).reshape(-1, 16))
+        np.save(ROW_KEYS, keys)
+        save_metadata(metadata)
+        with open(INDEX_INFO_FILE, 'w') as f:
+            json.dump({'type_ranges': type_ranges, 'next_key': next_key}, f)
+
+        # HNSW graph over the row keys for large indexes. Keys survive the
+        # regrouping, so an incremental run updates the existing graph in
+        # place; it is only rebuilt when new or on a full reindex.
+        if AnnIndex is not None and len(E) >= ANN_MIN_ROWS:
+            if has_keys and ANN_INDEX_FILE.exists():
+                ann = AnnIndex.restore(str(ANN_INDEX_FILE))
+                removed = old_keys[~keep]
+                if len(removed):
+                    ann.remove(removed)
+                if len(new_keys):
+                    ann.add(new_keys, new_E)
+            else:
+                ann = AnnIndex(ndim=EMBEDDING_DIM, metric='cos', dtype='f16')
+                ann.add(keys, E)
+            ann.save(str(ANN_INDEX_FILE))
+        elif ANN_INDEX_FILE.exists():
+            ANN_INDEX_FILE.unlink()  # Small enough to scan
+
+        # Save conversations for quick retrieval by id
+        save_conversations(conversation_map)
+
+        print(f"\n✓ Indexed {len(pending)} new messages ({len(unique_rows)} embedded) and dropped "
+              f"{len(keep) - len(kept)} stale ones, from {len(conversations)} conversations")
 
         return {
             "status": "success",
-            "indexed_messages": len(embeddings_data),
+            "indexed_messages": len(pending),
+            "embedded_messages": len(unique_rows),
+            "total_messages": len(E),
             "indexed_conversations": len(conversations)
         }
 
@@ -156,57 +403,106 @@ async def semantic_search(request: SemanticSearchRequest):
     """
     try:
         # Check if embeddings exist
-        if not EMBEDDINGS_FILE.exists():
+        if not EMBEDDINGS_MATRIX.exists():
             raise HTTPException(
                 status_code=404,
                 detail="No embeddings found. Please index conversations first using /index endpoint"
             )
 
-        # Load embeddings
-        with open(EMBEDDINGS_FILE, 'rb') as f:
-            embeddings_data = pickle.load(f)
-
-        # Load conversation map
-        with open(CONVERSATIONS_FILE, 'r') as f:
-            conversation_map = json.load(f)
+        # Load embeddings (memory-mapped, rows are paged in on demand)
+        E = get_cached(EMBEDDINGS_MATRIX, load_embeddings_matrix)
+        metadata = get_cached(METADATA_FILE, load_metadata)
+        index_info = get_cached(INDEX_INFO_FILE, load_index_info)
 
         # Create query embedding
         query_response = openai_client.embeddings.create(
-            model="text-embedding-3-small",
+            model=EMBEDDING_MODEL,
             input=request.query
         )
-        query_embedding = np.array(query_response.data[0].embedding)
+        q = np.asarray(query_response.data[0].embedding, dtype=np.float32)
+        # Only the query is normalized per request; stored rows already are
+        q /= np.sqrt(np.vdot(q, q))
+
+        # Rows are grouped by conversation type, so the type filter is a
+        # contiguous slice of the matrices rather than a mask over every row
+        start, stop = 0, len(E)
+        if request.filter_type:
+            start, stop = index_info['type_ranges'].get(request.filter_type, (0, 0))
+        view = slice(start, stop)
+
+        # Scoring writes into the shared scratch buffers
+        with _SCRATCH_LOCK:
+            # Candidates from the HNSW graph, or a coarse scan over a quantized
+            # copy of the index, if enabled. The approximate scores are only used
+            # for ranking; the best candidates are rescored in full precision.
+            # Slices under ANN_MIN_ROWS are cheaper to scan than to pick out of
+            # a widened graph search over the whole index.
+            candidates = None
+            if (AnnIndex is not None and ANN_INDEX_FILE.exists() and ROW_KEYS.exists()
+                    and stop > start and stop - start >= ANN_MIN_ROWS):
+                ann = get_cached(ANN_INDEX_FILE, load_ann_index)
+                # Widen the search when filtering, so enough hits land in the slice
+                count = request.top_k * RERANK_OVERSAMPLE * max(1, len(E) // (stop - start))
+                # usearch crashes on a count below 1, so never ask for fewer
+                keys = ann.search(q, count=max(1, min(count, len(E)))).keys.astype(np.int64)
+                key_rows = key_to_row(get_cached(ROW_KEYS, load_row_keys), keys)
+                candidates = key_rows[(key_rows >= start) & (key_rows < stop)] - start
+            elif SEARCH_QUANTIZATION == 'int8' and EMBEDDINGS_INT8.exists():
+                Eq = get_cached(EMBEDDINGS_INT8, load_embeddings_matrix)
+                q8 = quantize_int8(q)
+                candidates, _ = top_k_scan(
+                    Eq[view], lambda block, out: similarities(block, q8, out),
+                    request.top_k * RERANK_OVERSAMPLE
+                )
+            elif SEARCH_QUANTIZATION == 'binary' and EMBEDDINGS_BINARY.exists():
+                Eb = get_cached(EMBEDDINGS_BINARY, load_embeddings_matrix)
+                qb = np.packbits(q > 0)
+                # Fewer differing sign bits means more similar
+                candidates, _ = top_k_scan(
+                    Eb[view], lambda block, out: np.negative(hamming_distances(block, qb), out=out),
+                    request.top_k * RERANK_OVERSAMPLE
+                )
 
-        # Calculate cosine similarity for all embeddings
-        results = []
-        for item in embeddings_data:
-            # Apply type filter if specified
-            if request.filter_type and item['conversation_type'] != request.filter_type:
-                continue
-
-            embedding = np.array(item['embedding'])
-            similarity = np.dot(query_embedding, embedding) / (
-                np.linalg.norm(query_embedding) * np.linalg.norm(embedding)
-            )
+            if candidates is not None:
+                rows = start + np.sort(candidates)
+                sims = similarities(E[rows], q)
+            else:
+                # Cosine similarity as a plain dot product, one tile at a time
+                rows, sims = top_k_scan(
+                    E[view], lambda block, out: similarities(block, q, out),
+                    request.top_k, request.min_score
+                )
+                rows += start
 
-            if similarity >= request.min_score:
-                results.append({
-                    'conversation_id': item['conversation_id'],
-                    'conversation_title': item['conversation_title'],
-                    'message_content': item['message_content'],
-                    'message_role': item['message_role'],
-                    'similarity_score': float(similarity),
-                    'timestamp': item['timestamp'],
-                    'type': item['conversation_type'],
-                    'workspace_folder': item['workspace_folder'],
-                    'full_conversation': conversation_map.get(item['conversation_id'])
-                })
-
-        # Sort by similarity score
-        results.sort(key=lambda x: x['similarity_score'], reverse=True)
-
-        # Return top K results
-        return results[:request.top_k]
+        # Keep rows at or above min_score, then select the top K of those
+        # without sorting every row
+        matches = np.flatnonzero(sims >= request.min_score)
+        top = matches[top_k_indices(sims[matches], request.top_k)]
+
+        # Full conversations are fetched only for the returned rows, with one
+        # query and one decode per distinct conversation
+        conversations = fetch_conversations(
+            {metadata['conversation_id'][i] for i in rows[top]}
+        )
+
+        # Only the returned rows are materialized as result dicts
+        results = []
+        for j in top:
+            i = rows[j]
+            conversation_id = metadata['conversation_id'][i]
+            results.append({
+                'conversation_id': conversation_id,
+                'conversation_title': metadata['conversation_title'][i],
+                'message_content': metadata['message_content'][i],
+                'message_role': str(metadata['message_role'][i]),
+                'similarity_score': float(sims[j]),
+                'timestamp': int(metadata['timestamp'][i]),
+                'type': str(metadata['conversation_type'][i]),
+                'workspace_folder': metadata['workspace_folder'][i] or None,
+                'full_conversation': conversations.get(conversation_id)
+            })
+
+        return results
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -218,16 +514,14 @@ async def get_conversation(conversation_id: str):
     Retrieve full conversation by ID
     """
     try:
-        if not CONVERSATIONS_FILE.exists():
+        if not CONVERSATIONS_DB.exists():
             raise HTTPException(status_code=404, detail="No conversations indexed")
 
-        with open(CONVERSATIONS_FILE, 'r') as f:
-            conversation_map = json.load(f)
-
-        if conversation_id not in conversation_map:
+        conversation = fetch_conversation(conversation_id)
+        if conversation is None:
             raise HTTPException(status_code=404, detail="Conversation not found")
 
-        return conversation_map[conversation_id]
+        return conversation
 
     except HTTPException:
         raise
@@ -241,23 +535,329 @@ async def clear_index():
     Clear all indexed data
     """
     try:
-        if EMBEDDINGS_FILE.exists():
-            EMBEDDINGS_FILE.unlink()
-        if CONVERSATIONS_FILE.exists():
-            CONVERSATIONS_FILE.unlink()
+        # Drop cached (memory-mapped) files before deleting them
+        _CACHE.clear()
+
+        if EMBEDDINGS_MATRIX.exists():
+            EMBEDDINGS_MATRIX.unlink()
+        if EMBEDDINGS_INT8.exists():
+            EMBEDDINGS_INT8.unlink()
+        if EMBEDDINGS_BINARY.exists():
+            EMBEDDINGS_BINARY.unlink()
+        if METADATA_FILE.exists():
+            METADATA_FILE.unlink()
+        if INDEX_INFO_FILE.exists():
+            INDEX_INFO_FILE.unlink()
+        if CONTENT_HASHES.exists():
+            CONTENT_HASHES.unlink()
+        if ROW_KEYS.exists():
+            ROW_KEYS.unlink()
+        if ANN_INDEX_FILE.exists():
+            ANN_INDEX_FILE.unlink()
+        if CONVERSATIONS_DB.exists():
+            CONVERSATIONS_DB.unlink()
 
         return {"status": "success", "message": "Index cleared"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def similarities(E: np.ndarray, q: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Dot product of q with every row of E, written into out (float32) when
+    given. Stored rows and the query are unit-length, so this is their
+    cosine similarity without any per-row norm work (for the int8 copy it is
+    scaled by INT8_SCALE ** 2, which preserves the ranking). Uses simsimd's
+    runtime dispatched SIMD kernels when installed (float16 rows are read
+    natively via F16C/NEON), otherwise a float32 matrix-vector product.
+    Call with _SCRATCH_LOCK held.
+    """
+    if out is None:
+        out = np.empty(len(E), dtype=np.float32)
+    if not len(E):
+        return out
+    if simsimd is not None:
+        simsimd.cdist(
+            q.astype(E.dtype)[np.newaxis], E, metric='inner',
+            out=out[np.newaxis], out_dtype='float32'
+        )
+        return out
+    if E.dtype == np.float16:
+        # BLAS does not compute in float16, so upcast the rows
+        upcast = scratch('upcast', E.shape)
+        np.copyto(upcast, E)
+        E = upcast
+    return np.matmul(E, q.astype(np.float32), out=out)
+
+
+def scratch(name: str, shape: Tuple[int, ...]) -> np.ndarray:
+    """A float32 scratch buffer of the given shape, reused across requests"""
+    size = int(np.prod(shape))
+    buffer = _SCRATCH.get(name)
+    if buffer is None or buffer.size < size:
+        buffer = _SCRATCH[name] = np.empty(size, dtype=np.float32)
+    return buffer[:size].reshape(shape)
+
+
+def content_hash(content: str) -> bytes:
+    """16-byte BLAKE2b digest identifying a message's content"""
+    return hashlib.blake2b(content.encode(), digest_size=16).digest()
+
+
+def quantize_int8(x: np.ndarray) -> np.ndarray:
+    """Quantize unit-length vectors to int8 with the global INT8_SCALE"""
+    return np.clip(np.round(x * INT8_SCALE), -INT8_SCALE, INT8_SCALE).astype(np.int8)
+
+
+def hamming_distances(Eb: np.ndarray, qb: np.ndarray) -> np.ndarray:
+    """Hamming distance from packed query bits to every packed row"""
+    diff = np.bitwise_xor(Eb, qb)
+    if hasattr(np, 'bitwise_count'):
+        bits = np.bitwise_count(diff)
+    else:
+        bits = _POPCOUNT[diff]
+    return bits.sum(axis=1, dtype=np.int32)
+
+
+def top_k_scan(
+    E: np.ndarray,
+    score: Callable[[np.ndarray, np.ndarray], np.ndarray],
+    k: int,
+    min_score: float = -np.inf
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rows of E with the k highest score(rows, out) values (and at least
+    min_score), best first, along with those values. E is scored in row
+    tiles of about SCAN_BLOCK_BYTES into a reused scratch buffer, and each
+    tile's best rows are merged into a running top-k heap, so no score array
+    over all of E is ever materialized. Once the heap is full, tile rows
+    under its worst score are skipped outright. Call with _SCRATCH_LOCK held.
+    """
+    heap: List[Tuple[float, int]] = []  # (score, row), worst on top
+    if k <= 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+
+    advise_sequential(E)
+    block_rows = max(1, SCAN_BLOCK_BYTES // max(1, E[:1].nbytes))
+
+    for start in range(0, len(E), block_rows):
+        tile = E[start:start + block_rows]
+        sims = score(tile, scratch('sims', (len(tile),)))
+
+        threshold = heap[0][0] if len(heap) == k else min_score
+        passing = np.flatnonzero(sims >= threshold)
+        for row in passing[top_k_indices(sims[passing], k)]:
+            item = (float(sims[row]), start + int(row))
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+
+    heap.sort(reverse=True)
+    rows = np.array([row for _, row in heap], dtype=np.intp)
+    scores = np.array([s for s, _ in heap], dtype=np.float32)
+    return rows, scores
+
+
+def advise_sequential(E: np.ndarray) -> None:
+    """Ask the OS to read ahead through a memory-mapped matrix being scanned"""
+    mapping = getattr(E, '_mmap', None)
+    if mapping is not None and hasattr(mmap, 'MADV_SEQUENTIAL'):
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, without a full sort"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    top = np.argpartition(scores, -k)[-k:]
+    return top[np.argsort(scores[top])[::-1]]
+
+
+def refreshed_titles(metadata: Dict[str, list], conversation_map: Dict[str, Any]) -> List[str]:
+    """Row titles updated from conversation_map, for conversations it contains"""
+    return [
+        conversation_map[conv_id]['title'] if conv_id in conversation_map else title
+        for conv_id, title in zip(metadata['conversation_id'], metadata['conversation_title'])
+    ]
+
+
+class StringColumn:
+    """
+    A column of strings stored as one UTF-8 buffer plus row offsets, so it
+    round-trips through .npz without pickling Python objects. None is
+    stored as an empty string.
+    """
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, values: List[Optional[str]]) -> "StringColumn":
+        encoded = [(value or '').encode() for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode()
+
+    def tolist(self) -> List[str]:
+        return [self[i] for i in range(len(self))]
+
+
+def save_metadata(metadata: Dict[str, list]) -> None:
+    """
+    Save per-row metadata as typed columns: timestamps as int64, the small
+    categorical fields as fixed-width strings and free text as StringColumn
+    buffers. Nothing is pickled, so loading never unpickles file contents.
+    """
+    columns = {}
+    for field, values in metadata.items():
+        if field == 'timestamp':
+            columns[field] = np.asarray(values, dtype=np.int64)
+        elif field in ('conversation_type', 'message_role'):
+            columns[field] = np.asarray(values, dtype=str)
+        else:
+            column = StringColumn.from_strings(values)
+            columns[f'{field}_data'] = column.data
+            columns[f'{field}_offsets'] = column.offsets
+    np.savez(METADATA_FILE, **columns)
+
+
+def load_metadata(path: Path = METADATA_FILE) -> Dict[str, Any]:
+    """Load the per-row metadata columns saved by save_metadata()"""
+    metadata = {}
+    with np.load(path) as columns:
+        for field in METADATA_FIELDS:
+            if field in columns.files:
+                metadata[field] = columns[field]
+            else:
+                metadata[field] = StringColumn(columns[f'{field}_data'], columns[f'{field}_offsets'])
+    return metadata
+
+
+def load_index_info(path: Path = INDEX_INFO_FILE) -> Dict[str, Any]:
+    """Load the index layout (row range of each conversation type)"""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def load_row_keys(path: Path = ROW_KEYS) -> Tuple[np.ndarray, np.ndarray]:
+    """Load the row keys as a key -> row lookup: (sorted keys, their rows)"""
+    keys = np.load(path)
+    order = np.argsort(keys)
+    return keys[order], order
+
+
+def key_to_row(lookup: Tuple[np.ndarray, np.ndarray], keys: np.ndarray) -> np.ndarray:
+    """Rows holding the given keys (from load_row_keys), skipping unknown keys"""
+    sorted_keys, rows = lookup
+    pos = np.searchsorted(sorted_keys, keys).clip(max=len(sorted_keys) - 1)
+    found = sorted_keys[pos] == keys
+    return rows[pos[found]]
+
+
+def load_ann_index(path: Path = ANN_INDEX_FILE):
+    """Open the HNSW graph memory-mapped (view) rather than reading it in"""
+    return AnnIndex.restore(str(path), view=True)
+
+
+def load_embeddings_matrix(path: Path = EMBEDDINGS_MATRIX) -> np.ndarray:
+    """
+    Load an embeddings matrix memory-mapped, so opening it is O(1) and
+    the OS pages rows in on demand. Falls back to a regular load when the
+    file cannot be mapped.
+    """
+    try:
+        return np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        return np.load(path)
+
+
+def save_conversations(conversation_map: Dict[str, Any]) -> None:
+    """
+    Replace the conversation store with conversation_map: one SQLite row
+    per conversation, keyed by id, holding the orjson-encoded conversation
+    """
+    db = sqlite3.connect(CONVERSATIONS_DB)
+    try:
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS conv (id TEXT PRIMARY KEY, blob BLOB)")
+            db.execute("DELETE FROM conv")
+            db.executemany(
+                "INSERT INTO conv (id, blob) VALUES (?, ?)",
+                ((conv_id, orjson.dumps(conv)) for conv_id, conv in conversation_map.items())
+            )
+    finally:
+        db.close()
+
+
+def fetch_conversations(conversation_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Look up several full conversations by id, without loading the others"""
+    conversation_ids = list(conversation_ids)
+    if not conversation_ids:
+        return {}
+
+    placeholders = ", ".join("?" * len(conversation_ids))
+    db = sqlite3.connect(CONVERSATIONS_DB)
+    try:
+        rows = db.execute(
+            f"SELECT id, blob FROM conv WHERE id IN ({placeholders})",
+            conversation_ids
+        ).fetchall()
+    finally:
+        db.close()
+    return {conv_id: orjson.loads(blob) for conv_id, blob in rows}
+
+
+def fetch_conversation(conversation_id: str) -> Optional[Dict[str, Any]]:
+    """Point lookup of one full conversation, without loading the others"""
+    return fetch_conversations([conversation_id]).get(conversation_id)
+
+
+def count_conversations(path: Path = CONVERSATIONS_DB) -> int:
+    """Count the conversations in the store"""
+    db = sqlite3.connect(path)
+    try:
+        return db.execute("SELECT COUNT(*) FROM conv").fetchone()[0]
+    finally:
+        db.close()
+
+
+def get_cached(path: Path, loader: Callable[[Path], Any]) -> Any:
+    """
+    Return loader(path), reusing the previous result until the file's
+    mtime changes, so warm requests skip all file parsing
+    """
+    mtime = path.stat().st_mtime_ns
+    cached = _CACHE.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, loader(path))
+        _CACHE[path] = cached
+    return cached[1]
+
+
+def get_indexed_message_count() -> int:
+    """Get count of indexed messages (rows of the embeddings matrix)"""
+    try:
+        if EMBEDDINGS_MATRIX.exists():
+            return get_cached(EMBEDDINGS_MATRIX, load_embeddings_matrix).shape[0]
+        return 0
+    except:
+        return 0
+
+
 def get_indexed_count() -> int:
     """Get count of indexed conversations"""
     try:
-        if CONVERSATIONS_FILE.exists():
-            with open(CONVERSATIONS_FILE, 'r') as f:
-                data = json.load(f)
-            return len(data)
+        if CONVERSATIONS_DB.exists():
+            return get_cached(CONVERSATIONS_DB, count_conversations)
         return 0
     except:
         return 0